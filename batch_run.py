@@ -1,22 +1,279 @@
 #!/usr/bin/env python3
 from __future__ import annotations
-import argparse, json, os, pathlib, sys, concurrent.futures as cf
+import argparse, asyncio, json, os, pathlib, re, sys, tempfile, time, concurrent.futures as cf
 from typing import Any, Dict
-from payroll_pipeline import call_gpt5_compute_payroll
+import openai
+import orjson
+from payroll_pipeline import (
+    CCAA_REGION_MAP,
+    PAYROLL_RESULT_VALIDATOR,
+    VALIDATE_OUTPUT,
+    acall_gpt5_compute_payroll,
+    build_responses_request,
+    call_gpt5_compute_payroll_batch_prepared,
+    client,
+    extract_output_obj,
+    prepare_payload,
+    validate_with_schema,
+)
 
 OUTDIR = pathlib.Path(__file__).parent / "outputs"
 OUTDIR.mkdir(exist_ok=True, parents=True)
 
+# \w es Unicode-aware: conserva letras acentuadas/ñ de los nombres de CCAA
+_SLUG_RE = re.compile(r"[^\w-]+")
+
 def _safe_slug(s: str) -> str:
-    return "".join(ch for ch in s if ch.isalnum() or ch in ("-", "_")).strip("_")
+    return _SLUG_RE.sub("", s).strip("_")
+
+# Slugs precalculados para las ~19 CCAA conocidas (más el placeholder por defecto)
+_CCAA_SLUG_CACHE = {k: _safe_slug(k) for k in CCAA_REGION_MAP}
+_CCAA_SLUG_CACHE["CCAA"] = "CCAA"
+
+def write_result(i: int, obj: Dict[str, Any], res: Dict[str, Any]) -> None:
+    """Vuelca un resultado a disco en cuanto está disponible (progreso parcial ante fallos)."""
+    year = obj.get("period", {}).get("year", "YYYY")
+    month = obj.get("period", {}).get("month", "MM")
+    ccaa = obj.get("region_config", {}).get("ccaa", "CCAA")
+    slug = _CCAA_SLUG_CACHE.get(ccaa) or _safe_slug(ccaa)
+    name = f"{i:03d}_{slug}_{month}-{year}.json"
+    (OUTDIR / name).write_bytes(orjson.dumps(res, option=orjson.OPT_INDENT_2))
+    print(f"[OK] {name}")
+
+# Errores transitorios de la API que merecen reintento
+_RETRYABLE = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+async def _process_record_async(sem: asyncio.Semaphore, payload: Dict[str, Any],
+                                missing_policy: str, attempts: int = 3,
+                                executor=None) -> Dict[str, Any]:
+    """Una llamada con concurrencia acotada y hasta 3 intentos con backoff exponencial."""
+    async with sem:
+        delay = 1.0
+        for attempt in range(1, attempts + 1):
+            try:
+                return await acall_gpt5_compute_payroll(payload, missing_policy=missing_policy,
+                                                        executor=executor)
+            except _RETRYABLE:
+                if attempt == attempts:
+                    raise
+                await asyncio.sleep(delay)
+                delay *= 2
+
+# Tamaño de lectura del JSONL de entrada (1 MiB por read())
+_READ_CHUNK = 1 << 20
+
+def iter_records(path: pathlib.Path):
+    """Genera (línea, obj) parseando el JSONL bajo demanda, sin cargar todo el fichero en RAM.
+
+    Lee en binario por bloques grandes y trocea con buffer.find(b'\\n') en C,
+    evitando la maquinaria de líneas/decodificación del modo texto.
+    """
+    line_num = 0
+
+    def _parse(raw: bytes):
+        nonlocal line_num
+        line_num += 1
+        raw = raw.strip()
+        if not raw:
+            return None
+        try:
+            return line_num, orjson.loads(raw)
+        except orjson.JSONDecodeError as e:
+            print(f"[SKIP] Line {line_num} JSON error: {e}", file=sys.stderr)
+            return None
+
+    buf = bytearray()
+    with path.open("rb") as f:
+        while chunk := f.read(_READ_CHUNK):
+            buf += chunk
+            start = 0
+            while (nl := buf.find(b"\n", start)) != -1:
+                rec = _parse(bytes(buf[start:nl]))
+                if rec is not None:
+                    yield rec
+                start = nl + 1
+            del buf[:start]
+    if buf:  # última línea sin '\n' final
+        rec = _parse(bytes(buf))
+        if rec is not None:
+            yield rec
+
+async def run_async(records, workers: int, missing_policy: str, executor=None):
+    """Procesa los registros con asyncio: I/O-bound, sin un hilo OS por llamada."""
+    sem = asyncio.Semaphore(max(1, workers))
+
+    async def _handle(i, obj):
+        res = await _process_record_async(sem, obj, missing_policy, executor=executor)
+        # escribe en cuanto completa: el disco se solapa con las llamadas aún en vuelo
+        write_result(i, obj, res)
+        return res
+
+    meta, tasks = [], []
+    for i, obj in records:
+        meta.append((i, obj))
+        tasks.append(asyncio.create_task(_handle(i, obj)))
+        await asyncio.sleep(0)  # deja arrancar las llamadas mientras se siguen parseando líneas
+    outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+    results, errors = [], []
+    for (i, obj), out in zip(meta, outcomes):
+        if isinstance(out, BaseException):
+            errors.append((i, obj, str(out)))
+        else:
+            results.append((i, obj, out))
+    return results, errors
+
+def run_grouped(records, group_size: int, missing_policy: str):
+    """Agrupa K registros por llamada GPT: el prompt base se factura una vez por grupo."""
+    results, errors = [], []
+    pending = []
+    def _flush():
+        if not pending:
+            return
+        # Preflight por registro: un payload inválido no aborta ni contamina su grupo
+        ok_meta, prepared = [], []
+        for i, obj in pending:
+            try:
+                prepared.append(prepare_payload(obj, missing_policy=missing_policy))
+                ok_meta.append((i, obj))
+            except Exception as e:
+                errors.append((i, obj, str(e)))
+        if prepared:
+            try:
+                outs = call_gpt5_compute_payroll_batch_prepared(prepared, batch_size=group_size)
+                for (i, obj), res in zip(ok_meta, outs):
+                    write_result(i, obj, res)
+                    results.append((i, obj, res))
+            except Exception as e:
+                errors.extend((i, obj, str(e)) for i, obj in ok_meta)
+        pending.clear()
+
+    for rec in records:
+        pending.append(rec)
+        if len(pending) >= group_size:
+            _flush()
+    _flush()
+    return results, errors
+
+# Estados terminales de un job del Batch API
+_BATCH_TERMINAL = {"completed", "failed", "expired", "cancelled"}
+
+def run_batch_api(records, missing_policy: str):
+    """Envía todos los registros como un único job del Batch API (50% de coste, ventana 24h).
+
+    Devuelve (results, errors) con la misma forma que la ruta síncrona:
+    results = [(i, obj, res), ...], errors = [(i, obj, msg), ...].
+    """
+    results, errors = [], []
+    lines, meta = [], {}  # custom_id -> (i, obj, preflight_warnings)
+
+    for i, obj in records:
+        try:
+            enriched, warnings = prepare_payload(obj, missing_policy=missing_policy)
+        except Exception as e:
+            errors.append((i, obj, str(e)))
+            continue
+        custom_id = f"{i:03d}"
+        meta[custom_id] = (i, obj, warnings)
+        lines.append(json.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/responses",
+            "body": build_responses_request(enriched),
+        }, ensure_ascii=False))
+
+    if not lines:
+        return results, errors
 
-def process_record(idx: int, payload: Dict[str, Any], missing_policy: str) -> Dict[str, Any]:
-    return call_gpt5_compute_payroll(payload, missing_policy=missing_policy)
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", suffix=".jsonl", delete=False) as tmp:
+        tmp.write("\n".join(lines) + "\n")
+        tmp_path = pathlib.Path(tmp.name)
+    try:
+        with tmp_path.open("rb") as f:
+            batch_file = client.files.create(file=f, purpose="batch")
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/responses",
+        completion_window="24h",
+    )
+    print(f"[BATCH] Job {batch.id} enviado ({len(lines)} registros)", file=sys.stderr)
+
+    # Polling con backoff exponencial (5s → 60s máx.)
+    delay = 5.0
+    while batch.status not in _BATCH_TERMINAL:
+        time.sleep(delay)
+        delay = min(delay * 2, 60.0)
+        batch = client.batches.retrieve(batch.id)
+
+    if batch.status != "completed":
+        # No abortamos: los errores de preflight ya acumulados y los registros del job
+        # deben acabar igualmente en errors (y de ahí en errors.ndjson)
+        print(f"[BATCH] Job {batch.id} terminó con estado '{batch.status}'", file=sys.stderr)
+
+    # Si todas las peticiones fallaron, un job "completed" no trae output_file_id
+    if batch.output_file_id:
+        for raw in client.files.content(batch.output_file_id).iter_lines():
+            raw = raw.strip()
+            if not raw:
+                continue
+            entry = json.loads(raw)
+            pending = meta.pop(entry["custom_id"], None)
+            if pending is None:  # custom_id desconocido o duplicado: no aborta el resto
+                continue
+            i, obj, warnings = pending
+            response = entry.get("response") or {}
+            if entry.get("error") or response.get("status_code") != 200:
+                msg = entry.get("error") or response.get("body")
+                errors.append((i, obj, json.dumps(msg, ensure_ascii=False)))
+                continue
+            try:
+                res = extract_output_obj(response["body"]["output"])
+                if warnings:
+                    existing = res.get("warnings")
+                    res["warnings"] = warnings if existing is None else existing + warnings
+                if VALIDATE_OUTPUT:
+                    validate_with_schema(res, PAYROLL_RESULT_VALIDATOR, "PayrollResultSchema")
+                write_result(i, obj, res)
+                results.append((i, obj, res))
+            except Exception as e:
+                errors.append((i, obj, str(e)))
+
+    # Las peticiones rechazadas van a un fichero de errores aparte, no al de salida
+    if batch.error_file_id:
+        for raw in client.files.content(batch.error_file_id).iter_lines():
+            raw = raw.strip()
+            if not raw:
+                continue
+            entry = json.loads(raw)
+            pending = meta.pop(entry["custom_id"], None)
+            if pending is None:
+                continue
+            i, obj, _ = pending
+            msg = entry.get("error") or (entry.get("response") or {}).get("body")
+            errors.append((i, obj, json.dumps(msg, ensure_ascii=False)))
+
+    # Todo registro enviado debe acabar en results o en errors, aunque el job no lo devuelva
+    leftover_msg = ("El Batch API no devolvió resultado para este registro"
+                    if batch.status == "completed"
+                    else f"Batch {batch.id} terminó con estado '{batch.status}'")
+    for i, obj, _ in meta.values():
+        errors.append((i, obj, leftover_msg))
+
+    return results, errors
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--input", required=True, help="Path to JSONL with one PayrollInput per line")
+    parser.add_argument("--mode", choices=["sync", "batch"], default="sync",
+                        help="sync: una llamada por registro; batch: un job del Batch API (50%% coste, <24h)")
     parser.add_argument("--workers", type=int, default=1, help="Parallel workers (default: 1)")
+    parser.add_argument("--group-size", type=int, default=1,
+                        help="Registros por llamada GPT en modo sync (1 = una llamada por registro)")
+    parser.add_argument("--cpu-workers", type=int, default=0,
+                        help="Procesos para el preflight (validación jsonschema); 0 = en el proceso principal. "
+                             "Incompatible con --missing-policy ask")
     parser.add_argument("--model", default=None, help="Override OPENAI_MODEL env var (e.g., gpt-5)")
     parser.add_argument("--missing-policy", choices=["ask","default","fail"], default="fail",
                         help="Cómo resolver datos faltantes: ask|default|fail")
@@ -30,56 +287,30 @@ def main():
         print(f"Input not found: {in_path}", file=sys.stderr)
         sys.exit(1)
 
-    records = []
-    with in_path.open("r", encoding="utf-8") as f:
-        for line_num, line in enumerate(f, start=1):
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                obj = json.loads(line)
-                records.append((line_num, obj))
-            except json.JSONDecodeError as e:
-                print(f"[SKIP] Line {line_num} JSON error: {e}", file=sys.stderr)
+    records = iter_records(in_path)
 
-    if not records:
-        print("No valid records found.", file=sys.stderr)
-        sys.exit(2)
-
-    results, errors = [], []
-    if args.workers > 1:
-        with cf.ThreadPoolExecutor(max_workers=args.workers) as ex:
-            fut2meta = {ex.submit(process_record, i, obj, args.missing_policy): (i, obj) for i, obj in records}
-            for fut in cf.as_completed(fut2meta):
-                i, obj = fut2meta[fut]
-                try:
-                    res = fut.result()
-                    results.append((i, obj, res))
-                except Exception as e:
-                    errors.append((i, obj, str(e)))
+    if args.mode == "batch":
+        results, errors = run_batch_api(records, args.missing_policy)
+    elif args.group_size > 1:
+        results, errors = run_grouped(records, args.group_size, args.missing_policy)
+    elif args.cpu_workers > 0 and args.missing_policy != "ask":
+        # La validación jsonschema es Python puro (GIL): se reparte entre procesos
+        # mientras el event loop mantiene las llamadas a la API en vuelo.
+        with cf.ProcessPoolExecutor(max_workers=args.cpu_workers) as ppool:
+            results, errors = asyncio.run(
+                run_async(records, args.workers, args.missing_policy, executor=ppool))
     else:
-        for i, obj in records:
-            try:
-                res = process_record(i, obj, args.missing_policy)
-                results.append((i, obj, res))
-            except Exception as e:
-                errors.append((i, obj, str(e)))
+        results, errors = asyncio.run(run_async(records, args.workers, args.missing_policy))
 
-    for (i, obj, res) in results:
-        year = obj.get("period", {}).get("year", "YYYY")
-        month = obj.get("period", {}).get("month", "MM")
-        ccaa = obj.get("region_config", {}).get("ccaa", "CCAA")
-        name = f"{i:03d}_{_safe_slug(ccaa)}_{month}-{year}.json"
-        out_path = OUTDIR / name
-        with out_path.open("w", encoding="utf-8") as f:
-            json.dump(res, f, ensure_ascii=False, indent=2)
-        print(f"[OK] {name}")
+    if not results and not errors:
+        print("No valid records found.", file=sys.stderr)
+        sys.exit(2)
 
     if errors:
         err_path = OUTDIR / "errors.ndjson"
-        with err_path.open("w", encoding="utf-8") as f:
+        with err_path.open("wb") as f:
             for (i, obj, msg) in errors:
-                f.write(json.dumps({"index": i, "error": msg}, ensure_ascii=False) + "\n")
+                f.write(orjson.dumps({"index": i, "error": msg}) + b"\n")
         print(f"[DONE with errors] {len(results)} ok, {len(errors)} errors → {err_path}", file=sys.stderr)
         sys.exit(3)
 
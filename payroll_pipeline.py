@@ -1,10 +1,12 @@
 # payroll_pipeline.py — with preflight + missing-policy and Structured Outputs (schema strict)
 from __future__ import annotations
-import os, json, pathlib
+import asyncio, copy, hashlib, mmap, os, json, pathlib, pickle, unicodedata
+import httpx
+import orjson
 from dataclasses import dataclass
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Sequence
 from jsonschema import Draft202012Validator, exceptions as js_exc
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 from dotenv import load_dotenv
 
 # ----------------------------
@@ -12,21 +14,86 @@ from dotenv import load_dotenv
 # ----------------------------
 load_dotenv()
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-5")
+# Con Structured Outputs en strict la API ya garantiza salida conforme al schema;
+# re-validar localmente es cinturón y tirantes, activable para depurar.
+VALIDATE_OUTPUT = os.getenv("PAYROLL_VALIDATE_OUTPUT", "0") == "1"
+# PAYROLL_DISABLE_CACHE=1 fuerza llamadas frescas a la API (ignora y no escribe la caché local)
+USE_CACHE = os.getenv("PAYROLL_DISABLE_CACHE", "0") != "1"
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 if not OPENAI_API_KEY:
     raise RuntimeError("Falta OPENAI_API_KEY en el entorno")
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Pool de conexiones compartido: evita handshakes TLS repetidos cuando hay fan-out de workers
+_HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=64)
+_HTTP_TIMEOUT = httpx.Timeout(120.0)
+client = OpenAI(api_key=OPENAI_API_KEY,
+                http_client=httpx.Client(limits=_HTTP_LIMITS, timeout=_HTTP_TIMEOUT))
+async_client = AsyncOpenAI(api_key=OPENAI_API_KEY,
+                           http_client=httpx.AsyncClient(limits=_HTTP_LIMITS, timeout=_HTTP_TIMEOUT))
 
 ROOT = pathlib.Path(__file__).parent
 SCHEMA_INPUT_PATH = ROOT / "schemas" / "payroll_input.schema.json"
 SCHEMA_OUTPUT_PATH = ROOT / "schemas" / "payroll_result.schema.json"
+CACHE_DIR = ROOT / "outputs" / "cache"
+CACHE_DIR.mkdir(exist_ok=True, parents=True)
+
+# Caché de schemas parseados: pickle.load es bastante más rápido que re-parsear el JSON
+# en cada proceso nuevo (cada worker del batch); se invalida por mtime de los ficheros.
+_SCHEMA_PKL = pathlib.Path.home() / ".cache" / "payroll_es" / "schemas.pkl"
 
 def _load_json(path: pathlib.Path) -> dict:
-    with path.open("r", encoding="utf-8") as f:
-        return json.load(f)
+    with path.open("rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        mv = memoryview(mm)
+        try:
+            return orjson.loads(mv)
+        finally:
+            mv.release()
+
+def _load_schemas() -> tuple[dict, dict]:
+    paths = (SCHEMA_INPUT_PATH, SCHEMA_OUTPUT_PATH)
+    mtimes = tuple(p.stat().st_mtime for p in paths)
+    try:
+        with _SCHEMA_PKL.open("rb") as f:
+            cached = pickle.load(f)
+        if cached.get("mtimes") == mtimes:
+            return cached["schemas"]
+    except (OSError, EOFError, pickle.PickleError, KeyError, AttributeError):
+        pass
+    schemas = tuple(_load_json(p) for p in paths)
+    try:
+        _SCHEMA_PKL.parent.mkdir(parents=True, exist_ok=True)
+        with _SCHEMA_PKL.open("wb") as f:
+            pickle.dump({"mtimes": mtimes, "schemas": schemas}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        pass
+    return schemas
+
+PAYROLL_INPUT_SCHEMA, PAYROLL_RESULT_SCHEMA = _load_schemas()
+
+# Envoltorio para el modo lote: K registros por llamada, cada resultado etiquetado con su _batch_id
+PAYROLL_BATCH_RESULT_SCHEMA: dict = {
+    "type": "object",
+    "additionalProperties": False,
+    "required": ["results"],
+    "properties": {
+        "results": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "additionalProperties": False,
+                "required": ["_batch_id", "result"],
+                "properties": {
+                    "_batch_id": {"type": "integer"},
+                    "result": PAYROLL_RESULT_SCHEMA,
+                },
+            },
+        },
+    },
+}
 
-PAYROLL_INPUT_SCHEMA: dict = _load_json(SCHEMA_INPUT_PATH)
-PAYROLL_RESULT_SCHEMA: dict = _load_json(SCHEMA_OUTPUT_PATH)
+# Validadores compilados una sola vez (la resolución de refs/keywords no se repite por registro)
+PAYROLL_INPUT_VALIDATOR = Draft202012Validator(PAYROLL_INPUT_SCHEMA)
+PAYROLL_RESULT_VALIDATOR = Draft202012Validator(PAYROLL_RESULT_SCHEMA)
+PAYROLL_BATCH_RESULT_VALIDATOR = Draft202012Validator(PAYROLL_BATCH_RESULT_SCHEMA)
 
 # ----------------------------
 # 1) CCAA → IRPF map
@@ -53,6 +120,12 @@ CCAA_REGION_MAP: dict[str, dict] = {
     "Melilla": {"irpf_regime": "AEAT"},
 }
 
+def _normalize_ccaa(name: str) -> str:
+    """Clave canónica de CCAA: sin acentos y case-insensitive ("cataluña" == "Cataluña")."""
+    return unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode().casefold()
+
+_CCAA_NORMALIZED: dict[str, str] = {_normalize_ccaa(k): v["irpf_regime"] for k, v in CCAA_REGION_MAP.items()}
+
 # ----------------------------
 # 2) Prompt
 # ----------------------------
@@ -96,27 +169,34 @@ Instrucciones de cálculo y validación:
 9) Salida:
    - Devuelve JSON “PayrollResult” con desglose completo, CRA por concepto, trace y advertencias.
 
+Modo lote:
+   - Si la entrada es un objeto {"records": [...]} donde cada elemento lleva `_batch_id`,
+     calcula cada registro de forma independiente y devuelve
+     {"results": [{"_batch_id": ..., "result": PayrollResult}, ...]},
+     un resultado por registro, preservando su `_batch_id`.
+
 Responde SOLO con JSON válido que cumpla “PayrollResultSchema”. No incluyas texto adicional.
 """.strip()
 
 # ----------------------------
 # 3) Utils
 # ----------------------------
-def validate_with_schema(payload: dict, schema: dict, name: str) -> None:
+def validate_with_schema(payload: dict, validator: Draft202012Validator, name: str) -> None:
     try:
-        Draft202012Validator(schema).validate(payload)
+        validator.validate(payload)
     except js_exc.ValidationError as e:
         raise ValueError(f"Error de validación contra {name}: {e.message}\nRuta: {'/'.join(map(str, e.path))}") from e
 
 def enrich_region_config(payload: dict) -> dict:
-    data = json.loads(json.dumps(payload))
+    data = copy.deepcopy(payload)  # aísla al caller sin re-serializar todo el payload por JSON
     ccaa = data.get("region_config", {}).get("ccaa")
     if not ccaa:
         return data
     rc = data.setdefault("region_config", {})
     rc.setdefault("notes", "")
-    if "irpf_regime" not in rc and ccaa in CCAA_REGION_MAP:
-        rc["irpf_regime"] = CCAA_REGION_MAP[ccaa]["irpf_regime"]
+    if "irpf_regime" not in rc:
+        # Solo Navarra y País Vasco difieren; cualquier CCAA no reconocida cae en AEAT
+        rc["irpf_regime"] = _CCAA_NORMALIZED.get(_normalize_ccaa(ccaa), "AEAT")
     return data
 
 # ----------------------------
@@ -139,7 +219,28 @@ def _set_by_path(d: dict, path_parts: List[str], value: Any):
         cur = cur[p]
     cur[path_parts[-1]] = value
 
+def _make_setter(section: str, key: str):
+    def _set(payload: dict, value: Any) -> None:
+        sec = payload.get(section)
+        if not isinstance(sec, dict):
+            sec = payload[section] = {}
+        sec[key] = value
+    return _set
+
+# Setters directos para el conjunto cerrado de rutas de detect_missing:
+# evita el split(".") y el walker genérico de _set_by_path en cada asignación
+_SETTERS = {f"{sec}.{key}": _make_setter(sec, key) for sec, key in (
+    ("company", "atep_tariff_pct"),
+    ("tables", "cotization_year"),
+    ("tables", "irpf_year"),
+    ("compensation", "base_salary_cra_code"),
+    ("worker", "nif"),
+    ("region_config", "irpf_regime"),
+)}
+
 def _parse_input(value_str: str, mf: MissingField):
+    if mf.type == "string":  # el caso más común: sin replace ni comprobaciones
+        return value_str.strip()
     if mf.type == "number":
         return float(value_str.replace(",", "."))
     if mf.type == "enum":
@@ -149,12 +250,17 @@ def _parse_input(value_str: str, mf: MissingField):
         return v
     return value_str.strip()
 
-def detect_missing(payload: dict) -> List[MissingField]:
+# Singletons para el caso común "nada que preguntar": evitan asignar listas por registro
+_NO_MISSING: tuple = ()
+_NO_WARNINGS: tuple = ()
+
+def detect_missing(payload: dict) -> Sequence[MissingField]:
     missing: List[MissingField] = []
+    compensation = payload.get("compensation", {})
 
     # Plus Convenio en allowances sin importe declarado en compensation.variables
     has_plus_in_allowances = any((it.get("name","").lower() == "plus convenio") for it in payload.get("collective_agreement", {}).get("allowances", []))
-    has_plus_in_comp = any((v.get("name","").lower() == "plus convenio") for v in payload.get("compensation", {}).get("variables", []))
+    has_plus_in_comp = any((v.get("name","").lower() == "plus convenio") for v in compensation.get("variables", []))
     if has_plus_in_allowances and not has_plus_in_comp:
         missing.append(MissingField(
             path="compensation.plus_convenio_amount",
@@ -165,7 +271,7 @@ def detect_missing(payload: dict) -> List[MissingField]:
         ))
 
     # Tarifa AT/EP si no hay CNAE ni tarifa explícita
-    company = payload.setdefault("company", {})
+    company = payload.get("company", {})
     if not company.get("cnae") and not company.get("atep_tariff_pct"):
         missing.append(MissingField(
             path="company.atep_tariff_pct",
@@ -177,7 +283,7 @@ def detect_missing(payload: dict) -> List[MissingField]:
 
     # Año de tablas: cotización e IRPF
     period_year = payload.get("period", {}).get("year")
-    tables = payload.setdefault("tables", {})
+    tables = payload.get("tables", {})
     if not tables.get("cotization_year"):
         missing.append(MissingField(
             path="tables.cotization_year",
@@ -196,7 +302,7 @@ def detect_missing(payload: dict) -> List[MissingField]:
         ))
 
     # CRA base salarial
-    if not payload.get("compensation", {}).get("base_salary_cra_code"):
+    if not compensation.get("base_salary_cra_code"):
         missing.append(MissingField(
             path="compensation.base_salary_cra_code",
             question="Código CRA para salario base (p.ej. C01):",
@@ -226,12 +332,12 @@ def detect_missing(payload: dict) -> List[MissingField]:
             default="AEAT"
         ))
 
-    return missing
+    return missing or _NO_MISSING
 
-def resolve_missing(payload: dict, missing: List[MissingField], policy: str = "ask") -> tuple[dict, List[str]]:
-    warnings: List[str] = []
+def resolve_missing(payload: dict, missing: Sequence[MissingField], policy: str = "ask") -> tuple[dict, Sequence[str]]:
     if not missing:
-        return payload, warnings
+        return payload, _NO_WARNINGS
+    warnings: List[str] = []
 
     if policy == "fail":
         names = [m.path for m in missing]
@@ -267,28 +373,33 @@ def resolve_missing(payload: dict, missing: List[MissingField], policy: str = "a
                 vars_.append(found)
             found["amount"] = float(value) if value is not None else 0.0
         else:
-            _set_by_path(payload, m.path.split("."), value)
+            setter = _SETTERS.get(m.path)
+            if setter:
+                setter(payload, value)
+            else:
+                _set_by_path(payload, m.path.split("."), value)
 
     return payload, warnings
 
 # ----------------------------
 # 5) Call GPT-5
 # ----------------------------
-def call_gpt5_compute_payroll(input_payload: dict, missing_policy: str = "fail") -> dict:
-    validate_with_schema(input_payload, PAYROLL_INPUT_SCHEMA, "PayrollInputSchema")
+def prepare_payload(input_payload: dict, missing_policy: str = "fail") -> tuple[dict, List[str]]:
+    """Preflight completo: valida contra el schema, enriquece CCAA y resuelve faltantes."""
+    validate_with_schema(input_payload, PAYROLL_INPUT_VALIDATOR, "PayrollInputSchema")
     enriched = enrich_region_config(input_payload)
     missing = detect_missing(enriched)
-    enriched, preflight_warnings = resolve_missing(enriched, missing, policy=missing_policy)
-
-    messages = [
-        {"role": "developer", "content": BASE_PROMPT},
-        {"role": "user", "content": json.dumps(enriched, ensure_ascii=False)},
-    ]
-
-    resp = client.responses.create(
-        model=OPENAI_MODEL,
-        input=messages,
-        text={
+    return resolve_missing(enriched, missing, policy=missing_policy)
+
+def build_responses_request(enriched: dict) -> dict:
+    """Cuerpo de la petición a /v1/responses (compartido por el modo síncrono y el Batch API)."""
+    return {
+        "model": OPENAI_MODEL,
+        "input": [
+            {"role": "developer", "content": BASE_PROMPT},
+            {"role": "user", "content": orjson.dumps(enriched).decode()},
+        ],
+        "text": {
             "format": {
                 "type": "json_schema",
                 "schema": PAYROLL_RESULT_SCHEMA,
@@ -297,22 +408,172 @@ def call_gpt5_compute_payroll(input_payload: dict, missing_policy: str = "fail")
             },
             "verbosity": "low",
         },
-        reasoning={"effort": "medium"}
-    )
+        "reasoning": {"effort": "medium"},
+    }
 
-    output_obj: dict | None = None
-    for item in resp.output:
-        if getattr(item, "type", None) == "message":
+def parse_response_output(resp) -> dict:
+    """Decodifica la salida de una Response del SDK vía el agregado `output_text` (una pasada)."""
+    text = resp.output_text
+    if not text:
+        raise RuntimeError("No se pudo extraer la salida del modelo.")
+    return orjson.loads(text)
+
+def extract_output_obj(output: list) -> dict:
+    """Extrae el JSON de salida de una lista `output` cruda (líneas del Batch API)."""
+    for item in output:
+        if isinstance(item, dict):
+            if item.get("type") == "message":
+                for c in item.get("content", []):
+                    if c.get("type") == "output_text":
+                        return json.loads(c["text"])
+        elif getattr(item, "type", None) == "message":
             for c in getattr(item, "content", []):
                 if getattr(c, "type", None) == "output_text":
-                    output_obj = getattr(c, "parsed", None) or json.loads(c.text)
-                    break
-    if output_obj is None:
-        raise RuntimeError("No se pudo extraer la salida del modelo.")
+                    return getattr(c, "parsed", None) or json.loads(c.text)
+    raise RuntimeError("No se pudo extraer la salida del modelo.")
+
+def _request_id(request_body: dict) -> str:
+    """Id determinista de la petición completa (modelo, prompt, schema y payload incluidos):
+    misma petición → mismo id (reintentos idempotentes y caché); cambiar OPENAI_MODEL,
+    BASE_PROMPT o el schema de salida invalida las entradas antiguas por sí solo."""
+    return hashlib.blake2b(orjson.dumps(request_body, option=orjson.OPT_SORT_KEYS),
+                           digest_size=16).hexdigest()
+
+def _cache_get(req_id: str) -> dict | None:
+    if not USE_CACHE:
+        return None
+    path = CACHE_DIR / f"{req_id}.json"
+    if not path.exists():
+        return None
+    try:
+        return orjson.loads(path.read_bytes())
+    except orjson.JSONDecodeError:
+        return None
+
+def _cache_put(req_id: str, output_obj: dict) -> None:
+    if USE_CACHE:
+        (CACHE_DIR / f"{req_id}.json").write_bytes(orjson.dumps(output_obj))
+
+def call_gpt5_compute_payroll(input_payload: dict, missing_policy: str = "fail") -> dict:
+    enriched, preflight_warnings = prepare_payload(input_payload, missing_policy=missing_policy)
+
+    request_body = build_responses_request(enriched)
+    req_id = _request_id(request_body)
+    cached = _cache_get(req_id)
+    if cached is not None:
+        return cached
+
+    resp = client.responses.create(
+        **request_body,
+        extra_headers={"X-Request-Id": req_id, "OpenAI-Idempotency-Key": req_id},
+    )
+
+    output_obj = parse_response_output(resp)
+
+    if preflight_warnings:
+        existing = output_obj.get("warnings")
+        output_obj["warnings"] = preflight_warnings if existing is None else existing + preflight_warnings
+
+    if VALIDATE_OUTPUT:
+        validate_with_schema(output_obj, PAYROLL_RESULT_VALIDATOR, "PayrollResultSchema")
+    _cache_put(req_id, output_obj)
+    return output_obj
+
+def build_batch_responses_request(enriched_records: list[dict]) -> dict:
+    """Como build_responses_request pero con K registros bajo un único prompt (modo lote)."""
+    return {
+        "model": OPENAI_MODEL,
+        "input": [
+            {"role": "developer", "content": BASE_PROMPT},
+            {"role": "user", "content": orjson.dumps({"records": enriched_records}).decode()},
+        ],
+        "text": {
+            "format": {
+                "type": "json_schema",
+                "schema": PAYROLL_BATCH_RESULT_SCHEMA,
+                "strict": True,
+                "name": "PayrollBatchResult"
+            },
+            "verbosity": "low",
+        },
+        "reasoning": {"effort": "medium"},
+    }
+
+def call_gpt5_compute_payroll_batch(payloads: list[dict], missing_policy: str = "fail",
+                                    batch_size: int = 10) -> list[dict]:
+    """Calcula varias nóminas por llamada: el prompt se tokeniza/factura una vez por cada K registros.
+
+    Devuelve los PayrollResult en el mismo orden que `payloads`.
+    """
+    prepared = [prepare_payload(p, missing_policy=missing_policy) for p in payloads]
+    return call_gpt5_compute_payroll_batch_prepared(prepared, batch_size=batch_size)
+
+def call_gpt5_compute_payroll_batch_prepared(prepared_payloads: list[tuple[dict, Sequence[str]]],
+                                             batch_size: int = 10) -> list[dict]:
+    """Como call_gpt5_compute_payroll_batch pero sobre pares (enriched, warnings) ya pasados
+    por prepare_payload, para que el caller pueda aislar errores de preflight por registro."""
+    results: dict[int, dict] = {}
+    for start in range(0, len(prepared_payloads), batch_size):
+        chunk = prepared_payloads[start:start + batch_size]
+        prepared, warnings_by_id = [], {}
+        for off, (enriched, warnings) in enumerate(chunk):
+            enriched["_batch_id"] = start + off
+            prepared.append(enriched)
+            warnings_by_id[start + off] = warnings
+
+        resp = client.responses.create(**build_batch_responses_request(prepared))
+        parsed = parse_response_output(resp)
+        if VALIDATE_OUTPUT:
+            validate_with_schema(parsed, PAYROLL_BATCH_RESULT_VALIDATOR, "PayrollBatchResultSchema")
+
+        for entry in parsed["results"]:
+            bid = entry["_batch_id"]
+            output_obj = entry["result"]
+            warnings = warnings_by_id.get(bid)
+            if warnings:
+                existing = output_obj.get("warnings")
+                output_obj["warnings"] = warnings if existing is None else existing + warnings
+            results[bid] = output_obj
+
+    missing_ids = [bid for bid in range(len(prepared_payloads)) if bid not in results]
+    if missing_ids:
+        raise RuntimeError(f"El modelo no devolvió resultado para _batch_id: {missing_ids}")
+    return [results[bid] for bid in range(len(prepared_payloads))]
+
+async def acall_gpt5_compute_payroll(input_payload: dict, missing_policy: str = "fail",
+                                     executor=None) -> dict:
+    """Variante async de call_gpt5_compute_payroll (para concurrencia con asyncio).
+
+    Con `executor` (p.ej. ProcessPoolExecutor) el preflight —validación jsonschema,
+    enriquecido y resolución de faltantes, todo CPU puro y atado al GIL— se despacha
+    a otro proceso mientras el event loop sigue con las llamadas en vuelo.
+    No compatible con missing_policy="ask" (input() no funciona en un subproceso).
+    """
+    if executor is None:
+        enriched, preflight_warnings = prepare_payload(input_payload, missing_policy=missing_policy)
+    else:
+        loop = asyncio.get_running_loop()
+        enriched, preflight_warnings = await loop.run_in_executor(
+            executor, prepare_payload, input_payload, missing_policy)
+
+    request_body = build_responses_request(enriched)
+    req_id = _request_id(request_body)
+    cached = _cache_get(req_id)
+    if cached is not None:
+        return cached
+
+    resp = await async_client.responses.create(
+        **request_body,
+        extra_headers={"X-Request-Id": req_id, "OpenAI-Idempotency-Key": req_id},
+    )
+
+    output_obj = parse_response_output(resp)
 
     if preflight_warnings:
-        out_w = output_obj.setdefault("warnings", [])
-        out_w.extend(preflight_warnings)
+        existing = output_obj.get("warnings")
+        output_obj["warnings"] = preflight_warnings if existing is None else existing + preflight_warnings
 
-    validate_with_schema(output_obj, PAYROLL_RESULT_SCHEMA, "PayrollResultSchema")
+    if VALIDATE_OUTPUT:
+        validate_with_schema(output_obj, PAYROLL_RESULT_VALIDATOR, "PayrollResultSchema")
+    _cache_put(req_id, output_obj)
     return output_obj